@@ -36,14 +36,16 @@ ngrok.set_auth_token("36BnEYl1fkkpNnROxPhO5sbdv1Y_5QtyrMXSL9TwxXMiyTAe3")
 # -------------------------------
 # Imports
 # -------------------------------
-import base64, io, json, logging, threading, queue, sys
+import asyncio, base64, functools, heapq, io, json, logging, math, re, threading, queue, sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 from PIL import Image
 import fitz  # from pymupdf
 import requests
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
 from pydantic import BaseModel
 from openai import OpenAI
 import uvicorn
@@ -120,15 +122,18 @@ def health():
 # -------------------------------
 # PDF → Images
 # -------------------------------
-def pdf_to_images(pdf_bytes: bytes):
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    imgs = []
-    for page in doc:
-        pix = page.get_pixmap(matrix=fitz.Matrix(1.0, 1.0))
-        img = Image.open(io.BytesIO(pix.tobytes("jpeg", jpg_quality=70)))
-        imgs.append(img)
-    doc.close()
-    return imgs
+def render_page(doc, index: int):
+    """
+    Render one page. Returns (image, text_rows): text_rows is the number of
+    text-layer rows that look like table rows (see count_text_layer_rows),
+    or None for a scanned page without a text layer.
+    Pages are rendered one at a time so a document never holds more than
+    one decoded page image.
+    """
+    page = doc.load_page(index)
+    pix = page.get_pixmap(matrix=fitz.Matrix(1.0, 1.0))
+    img = Image.open(io.BytesIO(pix.tobytes("jpeg", jpg_quality=70)))
+    return img, count_text_layer_rows(page)
 
 # -------------------------------
 # Detect if URL is a PDF
@@ -149,42 +154,567 @@ def is_pdf_url(url: str, resp: requests.Response) -> bool:
 
     return False
 
+def count_pages(content: bytes, is_pdf: bool) -> int:
+    """
+    Cheap page count used for admission, before any page is rendered.
+    Opening the PDF only parses the xref table, no pixmaps are decoded.
+    """
+    if not is_pdf:
+        return 1
+    doc = fitz.open(stream=content, filetype="pdf")
+    n = doc.page_count
+    doc.close()
+    return max(n, 1)
+
+class InvalidDocument(Exception):
+    pass
+
+def fetch_document(url: str):
+    """Download + page count, as one DOWNLOAD_POOL job. Returns (response, is_pdf, n_pages)."""
+    r = requests.get(url, timeout=30)
+    r.raise_for_status()
+    # ✅ Robust PDF detection (handles ?query= etc.)
+    is_pdf = is_pdf_url(url, r)
+    try:
+        n_pages = count_pages(r.content, is_pdf)
+    except Exception as e:
+        raise InvalidDocument(e) from e
+    return r, is_pdf, n_pages
+
 # -------------------------------
-# Extract Single Page
+# Admission Control (page-based)
 # -------------------------------
-async def extract_page(img: Image.Image, page_num: int):
-    logger.info(f"Processing page {page_num}...")
+# All limits are counted in PAGES, not requests: one 40-page PDF means
+# 40 model calls, a single PNG means one.
+MAX_INFLIGHT_PAGES = int(os.environ.get("MAX_INFLIGHT_PAGES", "16"))
+MAX_QUEUED_PAGES = int(os.environ.get("MAX_QUEUED_PAGES", "64"))
+# Deadline from arrival to admission (download + queue). Pages of one
+# document run one after another, so a full-size (16-page) document holds
+# the budget for ~16 x 5s; the deadline must cover that.
+QUEUE_TIMEOUT_S = float(os.environ.get("QUEUE_TIMEOUT_S", "120"))
+
+# X-API-Key is only trusted if it is listed in API_KEYS (comma-separated).
+# Known keys get PER_KEY_PAGE_QUOTA each; missing/unknown keys all share the
+# "anonymous" bucket, which by default is only bounded by the global limits.
+API_KEYS = {k.strip() for k in os.environ.get("API_KEYS", "").split(",") if k.strip()}
+PER_KEY_PAGE_QUOTA = int(os.environ.get("PER_KEY_PAGE_QUOTA", "32"))  # inflight + queued, per API key
+ANON_PAGE_QUOTA = int(os.environ.get("ANON_PAGE_QUOTA", str(MAX_INFLIGHT_PAGES + MAX_QUEUED_PAGES)))
+
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "4"))
+# Downloads running + waiting for a DOWNLOAD_POOL thread; beyond this → 503
+MAX_PENDING_DOWNLOADS = int(os.environ.get("MAX_PENDING_DOWNLOADS", str(4 * DOWNLOAD_WORKERS)))
+
+# Not-yet-admitted work (download, page count) never competes with admitted
+# work (render, model calls) for threads. Admitted requests are at most
+# MAX_INFLIGHT_PAGES and each runs one job at a time, so WORK_POOL never queues.
+DOWNLOAD_POOL = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download")
+WORK_POOL = ThreadPoolExecutor(max_workers=MAX_INFLIGHT_PAGES, thread_name_prefix="extract")
+
+async def run_in(pool: ThreadPoolExecutor, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, functools.partial(fn, *args, **kwargs))
+
+def resolve_client(x_api_key: str | None) -> tuple[str, int]:
+    if x_api_key and x_api_key in API_KEYS:
+        return x_api_key, PER_KEY_PAGE_QUOTA
+    return "anonymous", ANON_PAGE_QUOTA
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    FIFO admission in front of the extractor.
+    - at most `max_pending_downloads` requests may be downloading / waiting
+      for a download thread
+    - `max_inflight` pages may be processed at once
+    - up to `max_queued` more pages may wait; every request must be admitted
+      within `timeout` s of arriving
+    - each key may hold at most its quota in pages (inflight + queued)
+    Anything beyond that, or anything whose estimated wait already exceeds
+    its deadline, is shed immediately with a Retry-After hint.
+    Must only be used from the server's event loop.
+    """
 
+    def __init__(self, max_inflight: int, max_queued: int, timeout: float,
+                 max_pending_downloads: int, download_workers: int):
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.max_pending_downloads = max_pending_downloads
+        self.download_workers = download_workers
+
+        self.inflight_pages = 0
+        self.queued_pages = 0
+        self.pending_downloads = 0
+        self.per_key: dict[str, int] = {}
+        self.waiters: deque = deque()  # (future, cost, pages, key)
+        # ticket -> [key, pages, cost, pages_done, last_progress]
+        self.running: dict[int, list] = {}
+        self.next_ticket = 0
+        self.shed = {
+            "downloads_full": 0, "queue_full": 0, "deadline": 0,
+            "key_quota": 0, "queue_timeout": 0,
+        }
+        self.admitted = 0
+        self.sec_per_page = 5.0      # EMA, seeded with a rough grok-4 page latency
+        self.sec_per_download = 2.0  # EMA
+
+    def _cost(self, pages: int) -> int:
+        # Pages are rendered one at a time, so a document bigger than the
+        # whole budget can still run, just alone.
+        return min(pages, self.max_inflight)
+
+    def _remaining(self, entry: list, now: float) -> float:
+        # Never "done now" while still running: a page slower than the
+        # average still has at least one more page-time to go.
+        _, pages, _, done, last = entry
+        return max(self.sec_per_page, (pages - done) * self.sec_per_page - (now - last))
+
+    def _schedule(self, pages: int | None = None) -> tuple[float, list]:
+        """
+        Replay the FIFO queue against the finish times of running documents.
+        Returns (admit time of a new `pages`-page request, [(finish, key)]
+        for every running and queued request).
+        """
+        now = time.monotonic()
+        finish = [(self._remaining(e, now), e[2]) for e in self.running.values()]
+        ends = [(f, e[0]) for (f, _), e in zip(finish, self.running.values())]
+        heapq.heapify(finish)
+        free = self.max_inflight - self.inflight_pages
+        t = 0.0
+        pending = [(c, n, k) for f, c, n, k in self.waiters if not f.done()]
+        if pages is not None:
+            pending.append((self._cost(pages), pages, None))
+        for cost, n, k in pending:
+            while free < cost and finish:
+                t, freed = heapq.heappop(finish)
+                free += freed
+            free -= cost
+            heapq.heappush(finish, (t + n * self.sec_per_page, cost))
+            if k is not None:
+                ends.append((t + n * self.sec_per_page, k))
+        return t, ends
+
+    def estimate_wait(self, pages: int) -> float:
+        """Seconds until a new `pages`-page request would be admitted."""
+        return self._schedule(pages)[0]
+
+    def retry_after(self, pages: int = 1) -> int:
+        return max(1, math.ceil(self.estimate_wait(pages)))
+
+    def key_retry_after(self, key: str) -> int:
+        # When this key's own quota starts to free up, not the global queue
+        ends = [f for f, k in self._schedule()[1] if k == key]
+        return max(1, math.ceil(min(ends, default=0.0)))
+
+    def begin_download(self):
+        if self.pending_downloads >= self.max_pending_downloads:
+            self.shed["downloads_full"] += 1
+            backlog = self.pending_downloads / self.download_workers
+            raise Rejected(503, "server saturated", max(1, math.ceil(backlog * self.sec_per_download)))
+        self.pending_downloads += 1
+
+    def end_download(self, elapsed: float | None = None):
+        self.pending_downloads -= 1
+        if elapsed is not None:
+            self.sec_per_download = 0.8 * self.sec_per_download + 0.2 * elapsed
+
+    def _start(self, key: str, pages: int, cost: int) -> int:
+        self.next_ticket += 1
+        self.running[self.next_ticket] = [key, pages, cost, 0, time.monotonic()]
+        self.admitted += 1
+        return self.next_ticket
+
+    def _wake(self):
+        # Strict FIFO: a large head-of-line document is not starved by small ones.
+        while self.waiters:
+            fut, cost, _, _ = self.waiters[0]
+            if fut.done():
+                self.waiters.popleft()
+                continue
+            if self.inflight_pages + cost > self.max_inflight:
+                break
+            self.waiters.popleft()
+            self.queued_pages -= cost
+            self.inflight_pages += cost
+            fut.set_result(True)
+
+    async def acquire(self, key: str, pages: int, quota: int, arrived: float) -> int:
+        """Returns a ticket to hand back to release(). `arrived` is time.monotonic() at arrival."""
+        cost = self._cost(pages)
+
+        # max(..., cost): a single document is never rejected just for being big
+        if self.per_key.get(key, 0) + cost > max(quota, cost):
+            self.shed["key_quota"] += 1
+            raise Rejected(429, "per-key page quota exceeded", self.key_retry_after(key))
+
+        if not self.waiters and self.inflight_pages + cost <= self.max_inflight:
+            self.inflight_pages += cost
+            self._charge(key, cost)
+            return self._start(key, pages, cost)
+
+        if self.queued_pages + cost > max(self.max_queued, cost):
+            self.shed["queue_full"] += 1
+            raise Rejected(503, "server saturated", self.retry_after(pages))
+
+        budget = arrived + self.timeout - time.monotonic()
+        wait = self.estimate_wait(pages)
+        if wait > budget:
+            # Would only time out in the queue: fail fast instead
+            self.shed["deadline"] += 1
+            raise Rejected(503, "server saturated", max(1, math.ceil(wait)))
+
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append((fut, cost, pages, key))
+        self.queued_pages += cost
+        self._charge(key, cost)
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=budget)
+        except BaseException as e:
+            if fut.done():
+                # granted in the same tick the timeout / disconnect fired
+                ticket = self._start(key, pages, cost)
+                if isinstance(e, asyncio.TimeoutError):
+                    return ticket
+                self.release(ticket)
+                raise
+            fut.cancel()
+            self.queued_pages -= cost
+            self._charge(key, -cost)
+            self._wake()
+            if isinstance(e, asyncio.TimeoutError):
+                self.shed["queue_timeout"] += 1
+                raise Rejected(503, "timed out waiting in queue", self.retry_after(pages))
+            raise
+        return self._start(key, pages, cost)
+
+    def _charge(self, key: str, delta: int):
+        left = self.per_key.get(key, 0) + delta
+        if left > 0:
+            self.per_key[key] = left
+        else:
+            self.per_key.pop(key, None)
+
+    def page_done(self, ticket: int):
+        entry = self.running[ticket]
+        now = time.monotonic()
+        self.sec_per_page = 0.8 * self.sec_per_page + 0.2 * (now - entry[4])
+        entry[3] += 1
+        entry[4] = now
+
+    def release(self, ticket: int):
+        key, _, cost, _, _ = self.running.pop(ticket)
+        self.inflight_pages -= cost
+        self._charge(key, -cost)
+        self._wake()
+
+    def stats(self) -> dict:
+        return {
+            "pending_downloads": self.pending_downloads,
+            "max_pending_downloads": self.max_pending_downloads,
+            "inflight_pages": self.inflight_pages,
+            "inflight_requests": len(self.running),
+            "queued_pages": self.queued_pages,
+            "queued_requests": sum(1 for w in self.waiters if not w[0].done()),
+            "max_inflight_pages": self.max_inflight,
+            "max_queued_pages": self.max_queued,
+            "admitted": self.admitted,
+            "shed": dict(self.shed),
+            "sec_per_page_ema": round(self.sec_per_page, 2),
+            "sec_per_download_ema": round(self.sec_per_download, 2),
+            "est_wait_s": round(self.estimate_wait(1), 1),
+        }
+
+admission = AdmissionController(
+    MAX_INFLIGHT_PAGES, MAX_QUEUED_PAGES, QUEUE_TIMEOUT_S, MAX_PENDING_DOWNLOADS, DOWNLOAD_WORKERS
+)
+
+async def run_download(fn, *args, **kwargs):
+    """
+    Run `fn` on DOWNLOAD_POOL, counted in admission.pending_downloads from
+    submission until the job has actually left the pool (finished, or
+    cancelled while still waiting for a thread).
+    """
+    loop = asyncio.get_running_loop()
+    admission.begin_download()
+    started = time.monotonic()
+    cf = DOWNLOAD_POOL.submit(functools.partial(fn, *args, **kwargs))
+
+    def done(f):
+        elapsed = None if f.cancelled() or f.exception() else time.monotonic() - started
+        loop.call_soon_threadsafe(admission.end_download, elapsed)
+
+    cf.add_done_callback(done)
+    return await asyncio.wrap_future(cf)
+
+@app.get("/admission-stats")
+def admission_stats():
+    return admission.stats()
+
+# -------------------------------
+# Token Budgeting (per page)
+# -------------------------------
+# Output is the slow part of a completion, so each page gets a max_tokens
+# sized from a cheap row estimate, and the model answers in a compact schema:
+#   {"t": "D|F|P|U", "r": [["item_name", amount, rate, quantity], ...]}
+# which expand_compact() turns back into the BillItem shape.
+# Per-row / fixed output cost for each schema. A verbose row repeats four
+# key names and costs roughly twice a compact array row.
+TOKENS_PER_ROW = {True: 24, False: 50}      # keyed by compact
+TOKENS_OVERHEAD = {True: 40, False: 60}     # braces/keys + slack for code fences
+BUDGET_MARGIN = 1.3
+MIN_MAX_TOKENS = 200
+MAX_MAX_TOKENS = int(os.environ.get("MAX_MAX_TOKENS", "4000"))
+COMPACT_OUTPUT = os.environ.get("COMPACT_OUTPUT", "1") == "1"
+# Estimates below LOW_EST_ROWS are more likely a miss (blank-looking scan,
+# merged grid) than a truly empty page, so they get a safe default instead.
+LOW_EST_ROWS = 3
+DEFAULT_EST_ROWS = 40
+
+PAGE_TYPE_CODES = {"D": "Bill Detail", "F": "Final Bill", "P": "Pharmacy", "U": "Unknown"}
+
+def count_text_layer_rows(page) -> int | None:
+    """
+    Rows in the PDF text layer that carry at least one number. Words are
+    grouped into visual rows by vertical centre, within half a word height,
+    so a label and its amount on slightly different baselines stay together.
+    None when the page has no text layer (scanned image).
+    """
+    words = page.get_text("words")
+    if not words:
+        return None
+    rows: list[list] = []  # [centre, height, tokens]
+    for x0, y0, x1, y1, text, *_ in sorted(words, key=lambda w: (w[1] + w[3]) / 2):
+        centre, height = (y0 + y1) / 2, y1 - y0
+        if rows and abs(centre - rows[-1][0]) <= 0.5 * min(height, rows[-1][1]):
+            rows[-1][2].append(text)
+        else:
+            rows.append([centre, height, [text]])
+    return sum(
+        1 for _, _, ws in rows
+        if len(ws) >= 2 and any(ch.isdigit() for t in ws for ch in t)
+    )
+
+def _erase_runs(data: bytearray, line: bytes, min_run: int, index):
+    # Zero every ink run of at least `min_run` pixels; index(i) maps the
+    # position within `line` back to an offset in `data`.
+    for m in re.finditer(b"\x01{%d,}" % min_run, line):
+        for i in range(m.start(), m.end()):
+            data[index(i)] = 0
+
+def count_image_lines(img: Image.Image, width: int = 400) -> int:
+    """
+    Cheap OCR-free row count on a downscaled 1-bit copy. Long horizontal
+    and vertical rules (table borders, grids) are erased first, so a
+    bordered table does not merge into a single band; what is left are
+    text lines, counted as horizontal bands of ink.
+    """
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        # Transparent background would turn black under convert("L")
+        bg = Image.new("RGBA", img.size, "white")
+        bg.alpha_composite(img.convert("RGBA"))
+        img = bg
+    g = img.convert("L")
+    width = min(width, g.width)
+    h = max(1, round(g.height * width / g.width))
+    g = g.resize((width, h))
+
+    # Dark background (negative scan): the light pixels are the ink
+    hist = g.histogram()
+    dark_bg = sum(i * c for i, c in enumerate(hist)) / (width * h) < 128
+    bw = g.point([1 if (p < 128) != dark_bg else 0 for p in range(256)])
+
+    # Find both kinds of rule on the untouched bitmap: erasing the vertical
+    # ones first would chop horizontal rules into short, surviving pieces.
+    rows = bw.tobytes()
+    cols = bw.transpose(Image.Transpose.TRANSPOSE).tobytes()
+    data = bytearray(rows)
+    v_run, h_run = max(8, h // 10), max(8, width // 5)
+    for x in range(width):
+        _erase_runs(data, cols[x * h:(x + 1) * h], v_run, lambda y, x=x: y * width + x)
+    for y in range(h):
+        _erase_runs(data, rows[y * width:(y + 1) * width], h_run, lambda i, y=y: y * width + i)
+
+    min_ink = max(2, width // 100)
+    bands, in_band = 0, False
+    for y in range(h):
+        inked = data.count(1, y * width, (y + 1) * width) >= min_ink
+        if inked and not in_band:
+            bands += 1
+        in_band = inked
+    return bands
+
+def estimate_rows(img: Image.Image, text_rows: int | None) -> tuple[int, str]:
+    """
+    Larger of the text-layer and image estimates: a hybrid PDF (digital
+    header or stamp over a scanned table) has a text layer that misses
+    most rows.
+    """
+    rows, source = count_image_lines(img), "image_lines"
+    if text_rows is not None and text_rows >= rows:
+        rows, source = text_rows, "text_layer"
+    if rows < LOW_EST_ROWS:
+        return DEFAULT_EST_ROWS, "default"
+    return rows, source
+
+def budget_max_tokens(est_rows: int, compact: bool) -> int:
+    tokens = math.ceil((TOKENS_OVERHEAD[compact] + est_rows * TOKENS_PER_ROW[compact]) * BUDGET_MARGIN)
+    return max(MIN_MAX_TOKENS, min(tokens, MAX_MAX_TOKENS))
+
+def build_prompt(page_num: int, compact: bool) -> str:
+    if not compact:
+        return (
+            f"You are an invoice/bill parser. Extract all item rows for page {page_num}.\n"
+            f"Return a valid JSON object of the form:\n"
+            f'{{"page_type": "Bill Detail | Final Bill | Pharmacy | Unknown", '
+            f'"bill_items": [{{"item_name": "...", "item_amount": 0.0, "item_rate": 0.0, "item_quantity": 0.0}}...]}}\n'
+            f"Do not include any extra text, only JSON."
+        )
+    return (
+        'Extract every bill item row. Reply with only minified JSON: '
+        '{"t":T,"r":[[name,amount,rate,qty],...]} '
+        'T: "D"=Bill Detail,"F"=Final Bill,"P"=Pharmacy,"U"=Unknown. '
+        'Numbers plain, no currency or commas.'
+    )
+
+def expand_compact(parsed: dict, page_num: int) -> dict:
+    """Compact {"t","r"} reply → {"page_type","bill_items"}; verbose replies pass through."""
+    if "bill_items" in parsed or not ("t" in parsed or "r" in parsed):
+        return parsed
+    items = []
+    for row in parsed.get("r") or []:
+        if not (isinstance(row, list) and len(row) >= 4):
+            logger.error(f"Failed to parse item on page {page_num}: bad compact row {row!r}")
+            continue
+        items.append({
+            "item_name": row[0],
+            "item_amount": row[1],
+            "item_rate": row[2],
+            "item_quantity": row[3],
+        })
+    t = parsed.get("t", "U")
+    return {"page_type": PAGE_TYPE_CODES.get(t, t), "bill_items": items}
+
+def encode_page(img: Image.Image) -> str:
     buf = io.BytesIO()
     img.save(buf, format="JPEG", quality=70)
-    b64 = base64.b64encode(buf.getvalue()).decode()
-
-    prompt = (
-        f"You are an invoice/bill parser. Extract all item rows for page {page_num}.\n"
-        f"Return a valid JSON object of the form:\n"
-        f'{{"page_type": "Bill Detail | Final Bill | Pharmacy | Unknown", '
-        f'"bill_items": [{{"item_name": "...", "item_amount": 0.0, "item_rate": 0.0, "item_quantity": 0.0}}...]}}\n'
-        f"Do not include any extra text, only JSON."
-    )
+    return base64.b64encode(buf.getvalue()).decode()
+
+class TokenBudgetStats:
+    """Estimated vs actual per page, so the row estimator can be checked."""
+
+    def __init__(self, maxlen: int = 500):
+        self.records: deque = deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+
+    def record(self, **rec):
+        with self.lock:
+            self.records.append(rec)
+
+    def summary(self) -> dict:
+        with self.lock:
+            recs = list(self.records)
+        if not recs:
+            return {"pages": 0}
+        ok = [r for r in recs if not r["failed"]] or [{"est_rows": 0, "rows": 0, "completion_tokens": 0}]
+        # "default" pages used the fixed fallback, not the estimator: keep
+        # them out of the headline error and report each source separately
+        by_source: dict[str, list] = {}
+        for r in ok:
+            if "est_source" in r:
+                by_source.setdefault(r["est_source"], []).append(abs(r["est_rows"] - r["rows"]))
+        estimated = [e for src, errs in by_source.items() if src != "default" for e in errs]
+        called = [r for r in recs if r["final_completion_tokens"]] or [{"final_completion_tokens": 0, "est_max_tokens": 1}]
+        return {
+            "pages": len(recs),
+            "failed": sum(1 for r in recs if r["failed"]),
+            "truncated": sum(1 for r in recs if r["truncated"]),
+            "mean_abs_row_error": round(sum(estimated) / max(1, len(estimated)), 2),
+            "row_error_by_source": {
+                src: {"pages": len(errs), "mean_abs_row_error": round(sum(errs) / len(errs), 2)}
+                for src, errs in by_source.items()
+            },
+            # > 1.0 means the estimated budget was too small on average
+            "mean_est_budget_ratio": round(
+                sum(r["final_completion_tokens"] / r["est_max_tokens"] for r in called) / len(called), 3
+            ),
+            "retry_tokens": sum(r["completion_tokens"] - r["final_completion_tokens"] for r in recs),
+            "mean_tokens_per_row": round(
+                sum(r["completion_tokens"] for r in ok) / max(1, sum(r["rows"] for r in ok)), 1
+            ),
+            "recent": recs[-20:],
+        }
+
+token_stats = TokenBudgetStats()
+
+@app.get("/token-stats")
+def token_budget_stats():
+    return token_stats.summary()
 
+# -------------------------------
+# Extract Single Page
+# -------------------------------
+async def extract_page(img: Image.Image, page_num: int, text_rows: int | None = None):
+    # Row estimate and JPEG encode are pure CPU work: keep them off the loop
+    est_rows, est_source = await run_in(WORK_POOL, estimate_rows, img, text_rows)
+    max_tokens = budget_max_tokens(est_rows, COMPACT_OUTPUT)
+    logger.info(f"Processing page {page_num}... (~{est_rows} rows via {est_source}, max_tokens={max_tokens})")
+
+    b64 = await run_in(WORK_POOL, encode_page, img)
+
+    prompt = build_prompt(page_num, COMPACT_OUTPUT)
+
+    rec = {
+        "page": page_num,
+        "est_source": est_source,
+        "est_rows": est_rows,
+        "rows": 0,
+        "est_max_tokens": max_tokens,
+        "final_max_tokens": max_tokens,
+        "completion_tokens": 0,        # summed over all attempts
+        "final_completion_tokens": 0,
+        "truncated": False,
+        "failed": True,
+    }
     try:
-        resp = client.chat.completions.create(
-            model="grok-4",
-            messages=[{
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{b64}"
+        while True:
+            # Blocking SDK call runs in a worker thread so the loop can keep admitting/shedding
+            resp = await run_in(
+                WORK_POOL,
+                client.chat.completions.create,
+                model="grok-4",
+                messages=[{
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:image/jpeg;base64,{b64}"
+                            }
                         }
-                    }
-                ]
-            }],
-            max_tokens=1000,
-            temperature=0,
-        )
+                    ]
+                }],
+                max_tokens=max_tokens,
+                temperature=0,
+            )
+            used = getattr(getattr(resp, "usage", None), "completion_tokens", 0) or 0
+            rec["completion_tokens"] += used
+            rec["final_completion_tokens"] = used
+            rec["final_max_tokens"] = max_tokens
+            if resp.choices[0].finish_reason == "length":
+                rec["truncated"] = True
+            # Under-estimated a dense page: retry once with the full budget
+            if resp.choices[0].finish_reason == "length" and max_tokens < MAX_MAX_TOKENS:
+                logger.info(f"Page {page_num} truncated at {max_tokens} tokens, retrying with {MAX_MAX_TOKENS}")
+                max_tokens = MAX_MAX_TOKENS
+                continue
+            break
 
         # xAI Grok returns OpenAI-style chat completion
         txt = resp.choices[0].message.content
@@ -200,64 +730,111 @@ async def extract_page(img: Image.Image, page_num: int):
         if "{" in txt and "}" in txt:
             txt = txt[txt.find("{"): txt.rfind("}") + 1]
 
-        parsed = json.loads(txt)
+        parsed = expand_compact(json.loads(txt), page_num)
         bill_items = parsed.get("bill_items", [])
         logger.info(f"Page {page_num} → {len(bill_items)} items")
 
+        rec["rows"] = len(bill_items)
+        rec["failed"] = False
         return parsed
 
     except Exception as e:
         logger.error(f"Page {page_num} failed → {e}")
         return {"page_type": "Unknown", "bill_items": []}
 
+    finally:
+        # Failed and truncated pages are exactly what the estimator must see
+        token_stats.record(**rec)
+
 # -------------------------------
 # API Endpoint
 # -------------------------------
 @app.post("/extract-bill-data")
-async def api(req: RequestModel):
+async def api(req: RequestModel, x_api_key: str | None = Header(default=None)):
     logger.info(f"Judge triggered API with: {req.document}")
+    key, quota = resolve_client(x_api_key)
+    arrived = time.monotonic()
+
+    def shed(e: Rejected, what: str):
+        logger.info(f"Shed {what} request from {key}: {e.reason} (retry in {e.retry_after}s)")
+        return HTTPException(
+            status_code=e.status_code,
+            detail=e.reason,
+            headers={"Retry-After": str(e.retry_after)},
+        )
 
-    # Download the document
+    # Download + page count (off the event loop, bounded, and inside the
+    # arrival deadline so a download backlog is shed like a queue backlog)
     try:
-        r = requests.get(req.document, timeout=30)
-        r.raise_for_status()
+        r, is_pdf, n_pages = await asyncio.wait_for(
+            run_download(fetch_document, req.document), timeout=QUEUE_TIMEOUT_S
+        )
+    except Rejected as e:
+        raise shed(e, "unfetched")
+    except asyncio.TimeoutError:
+        admission.shed["queue_timeout"] += 1
+        raise shed(Rejected(503, "timed out waiting in queue", admission.retry_after()), "unfetched")
+    except InvalidDocument as e:
+        logger.error(f"Failed to parse document as PDF/image: {e}")
+        raise HTTPException(status_code=400, detail=f"Invalid or unsupported file format: {e}")
     except Exception as e:
         logger.error(f"Failed to download document: {e}")
         raise HTTPException(status_code=400, detail=f"Could not download document: {e}")
 
-    # ✅ Robust PDF detection (handles ?query= etc.)
+    # Admit by page count BEFORE decoding any page images
     try:
-        if is_pdf_url(req.document, r):
-            images = pdf_to_images(r.content)
-        else:
-            # Treat as image (PNG/JPEG/etc.)
-            images = [Image.open(io.BytesIO(r.content))]
-    except Exception as e:
-        logger.error(f"Failed to parse document as PDF/image: {e}")
-        raise HTTPException(status_code=400, detail=f"Invalid or unsupported file format: {e}")
+        ticket = await admission.acquire(key, n_pages, quota, arrived)
+    except Rejected as e:
+        raise shed(e, f"{n_pages}p")
 
-    pages: list[PageData] = []
-    total = 0
+    doc = None
+    try:
+        try:
+            if is_pdf:
+                doc = await run_in(WORK_POOL, fitz.open, stream=r.content, filetype="pdf")
+        except Exception as e:
+            logger.error(f"Failed to parse document as PDF/image: {e}")
+            raise HTTPException(status_code=400, detail=f"Invalid or unsupported file format: {e}")
 
-    for i, img in enumerate(images, 1):
-        res = await extract_page(img, i)
-        bill_items_raw = res.get("bill_items", []) or []
-        # Safely build BillItem objects
-        items: list[BillItem] = []
-        for x in bill_items_raw:
+        pages: list[PageData] = []
+        total = 0
+
+        for i in range(1, n_pages + 1):
             try:
-                items.append(BillItem(**x))
+                if doc is not None:
+                    img, rows = await run_in(WORK_POOL, render_page, doc, i - 1)
+                else:
+                    # Treat as image (PNG/JPEG/etc.)
+                    img, rows = Image.open(io.BytesIO(r.content)), None
             except Exception as e:
-                logger.error(f"Failed to parse item on page {i}: {e}")
-
-        pages.append(
-            PageData(
-                page_no=str(i),
-                page_type=res.get("page_type", "Unknown"),
-                bill_items=items,
+                logger.error(f"Failed to parse document as PDF/image: {e}")
+                raise HTTPException(status_code=400, detail=f"Invalid or unsupported file format: {e}")
+
+            res = await extract_page(img, i, rows)
+            del img  # only one decoded page alive per document
+            admission.page_done(ticket)
+
+            bill_items_raw = res.get("bill_items", []) or []
+            # Safely build BillItem objects
+            items: list[BillItem] = []
+            for x in bill_items_raw:
+                try:
+                    items.append(BillItem(**x))
+                except Exception as e:
+                    logger.error(f"Failed to parse item on page {i}: {e}")
+
+            pages.append(
+                PageData(
+                    page_no=str(i),
+                    page_type=res.get("page_type", "Unknown"),
+                    bill_items=items,
+                )
             )
-        )
-        total += len(items)
+            total += len(items)
+    finally:
+        if doc is not None:
+            doc.close()
+        admission.release(ticket)
 
     logger.info(f"FINISHED → Total extracted items: {total}")
 